@@ -1,14 +1,77 @@
 import azure.functions as func
+import asyncio
 import logging
 import json
 import os
+import re
 from PyPDF2 import PdfReader
-import io
-from openai import AzureOpenAI
+import pypdfium2 as pdfium
+import tiktoken
+import sys
+import time
+import functools
+import threading
+from types import MappingProxyType
+from typing import Literal
+import hashlib
+import gzip
+from collections import OrderedDict
+import httpx
+from openai import AsyncAzureOpenAI, DefaultAsyncHttpxClient
 from datetime import datetime, timezone
+from rapidfuzz import fuzz
+import msgspec
+
+try:
+    from orjson import dumps as _dumps
+except ImportError:  # orjson is an optional speedup; stdlib json is used without it
+    def _dumps(obj):
+        """Encode obj to compact UTF-8 JSON bytes, matching orjson.dumps output"""
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode()
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; gzip is offered without it
+    brotli = None
 
 app = func.FunctionApp()
+_HttpResponse = func.HttpResponse
+_UTC = timezone.utc
+
+# CORS headers are injected by the host (host.json extensions.http.customHeaders);
+# error responses only add this, so proxies and CDNs never hold on to a failure
+_ERROR_HEADERS = {"Cache-Control": "no-store"}
+
+# Fixed body for the last-resort 500 when even the error response cannot be built
+_CRITICAL_ERROR_BODY = b'{"error":"Critical error - unable to process request"}'
 
+# Evidence requirement profiles, shared by every control of the same type. Read-only
+# views, since one object is handed to every caller; use dict(profile) to get a copy.
+_EVIDENCE_REQ_TECH = MappingProxyType({
+    "type": "technical_implementation",
+    "policy_max_score": "Partially Meets",
+    "full_compliance_requires": ("system_evidence", "technical_proof", "implementation_verification"),
+    "reasoning": "Technical control requires system implementation evidence - policy alone insufficient",
+    "evidence_examples": "system configurations, screenshots, logs, audit reports, technical testing results"
+})
+
+_EVIDENCE_REQ_ORG = MappingProxyType({
+    "type": "organizational",
+    "policy_max_score": "Fully Meets",
+    "full_compliance_requires": ("policy", "procedures", "organizational_processes"),
+    "reasoning": "Organizational control can be met through documented policies and procedures",
+    "evidence_examples": "policy documents, procedures, organizational charts, training records"
+})
+
+_EVIDENCE_REQ_MIXED = MappingProxyType({
+    "type": "mixed_or_unclear",
+    "policy_max_score": "Partially Meets",
+    "full_compliance_requires": ("contextual_analysis_needed",),
+    "reasoning": "Control type unclear from definition - requires careful evidence analysis",
+    "assessment_note": "Analyze specific control requirements to determine appropriate evidence types"
+})
+
+@functools.lru_cache(maxsize=128)
 def determine_evidence_requirements(control_definition):
     """
     Analyze control definition to determine evidence requirements based on linguistic patterns.
@@ -17,33 +80,17 @@ def determine_evidence_requirements(control_definition):
     1. "The organization..." = Organizational control - can be fully met through policy/procedures
     2. "The information system..." = Technical control - requires system implementation evidence
     3. Other patterns = Mixed/unclear - requires careful analysis
+    
+    Returns one of the shared read-only module-level profiles, so results are
+    memoized per definition string.
     """
-    control_definition = control_definition.strip()
+    control_definition = control_definition.lstrip()
     
-    if control_definition.startswith("The information system"):
-        return {
-            "type": "technical_implementation",
-            "policy_max_score": "Partially Meets",
-            "full_compliance_requires": ["system_evidence", "technical_proof", "implementation_verification"],
-            "reasoning": "Technical control requires system implementation evidence - policy alone insufficient",
-            "evidence_examples": "system configurations, screenshots, logs, audit reports, technical testing results"
-        }
-    elif control_definition.startswith("The organization"):
-        return {
-            "type": "organizational",
-            "policy_max_score": "Fully Meets",
-            "full_compliance_requires": ["policy", "procedures", "organizational_processes"],
-            "reasoning": "Organizational control can be met through documented policies and procedures",
-            "evidence_examples": "policy documents, procedures, organizational charts, training records"
-        }
-    else:
-        return {
-            "type": "mixed_or_unclear",
-            "policy_max_score": "Partially Meets",
-            "full_compliance_requires": ["contextual_analysis_needed"],
-            "reasoning": "Control type unclear from definition - requires careful evidence analysis",
-            "assessment_note": "Analyze specific control requirements to determine appropriate evidence types"
-        }
+    if control_definition[:22] == "The information system":
+        return _EVIDENCE_REQ_TECH
+    if control_definition[:16] == "The organization":
+        return _EVIDENCE_REQ_ORG
+    return _EVIDENCE_REQ_MIXED
 
 # Enhanced NIST controls with pattern-based assessment
 NIST_CONTROLS = {
@@ -63,7 +110,8 @@ NIST_CONTROLS = {
                     "management_commitment": "Look for evidence of organizational leadership support, training requirements, or enforcement mechanisms",
                     "coordination": "Look for processes that involve multiple parties working together or communicating",
                     "compliance": "Look for enforcement mechanisms, consequences for violations, or compliance monitoring"
-                }
+                },
+                "keywords": ("access control", "policy", "purpose", "scope", "responsibilit")
             },
             "AC-1(A)(b)": {
                 "title": "Procedures development", 
@@ -73,7 +121,8 @@ NIST_CONTROLS = {
                     "implementation_focus": "Look for procedures that explain HOW to implement the policy",
                     "documentation": "Evidence that procedures are written down and maintained",
                     "dissemination": "Evidence that procedures are shared with relevant personnel"
-                }
+                },
+                "keywords": ("procedure", "process", "workflow", "instruction")
             },
             "AC-1(B)(a)": {
                 "title": "Policy review and update",
@@ -81,7 +130,8 @@ NIST_CONTROLS = {
                 "assessment_criteria": {
                     "review_frequency": "Look for evidence of regular reviews, version history, or update schedules",
                     "three_year_cycle": "Check if reviews happen at least every 3 years based on document dates"
-                }
+                },
+                "keywords": ("review", "update", "revision", "version", "3 years", "three years")
             },
             "AC-1(B)(b)": {
                 "title": "Procedures review and update",
@@ -89,7 +139,8 @@ NIST_CONTROLS = {
                 "assessment_criteria": {
                     "review_frequency": "Look for evidence of regular reviews, version history, or update schedules",
                     "annual_cycle": "Check if reviews happen at least annually based on document dates"
-                }
+                },
+                "keywords": ("review", "update", "revision", "version", "annual")
             }
         }
     },
@@ -104,7 +155,8 @@ NIST_CONTROLS = {
                 "assessment_criteria": {
                     "account_types": "Look for mentions of different user categories, account types, or user groups",
                     "business_alignment": "Evidence that account types are tied to business needs or functions"
-                }
+                },
+                "keywords": ("account", "user type", "user group", "user categor")
             },
             "AC-2(B)": {
                 "title": "Account manager assignment",
@@ -112,7 +164,8 @@ NIST_CONTROLS = {
                 "assessment_criteria": {
                     "manager_designation": "Look for assignment of specific people to manage accounts",
                     "accountability": "Evidence of who is responsible for account oversight"
-                }
+                },
+                "keywords": ("account manager", "account owner", "account", "administrator")
             },
             "AC-2(C)": {
                 "title": "Group and role membership conditions",
@@ -120,7 +173,8 @@ NIST_CONTROLS = {
                 "assessment_criteria": {
                     "membership_criteria": "Look for rules about who can belong to groups or roles",
                     "access_conditions": "Evidence of requirements for group/role assignment"
-                }
+                },
+                "keywords": ("group", "role", "membership")
             },
             "AC-2(D)": {
                 "title": "Account specifications",
@@ -129,7 +183,8 @@ NIST_CONTROLS = {
                     "user_specification": "Look for identification of authorized users",
                     "privilege_definition": "Evidence of defined access levels and permissions",
                     "attribute_management": "Documentation of account attributes and characteristics"
-                }
+                },
+                "keywords": ("authorized user", "authorised user", "privilege", "permission", "access level")
             },
             "AC-2(E)": {
                 "title": "Account creation approval",
@@ -137,7 +192,8 @@ NIST_CONTROLS = {
                 "assessment_criteria": {
                     "approval_process": "Look for requirement that managers must approve new accounts",
                     "formal_request": "Evidence of formal process for requesting new accounts"
-                }
+                },
+                "keywords": ("approv", "request")
             },
             "AC-2(F)": {
                 "title": "Account lifecycle management",
@@ -145,7 +201,8 @@ NIST_CONTROLS = {
                 "assessment_criteria": {
                     "lifecycle_processes": "Look for procedures covering account creation, modification, disabling, removal",
                     "systematic_approach": "Evidence of organized processes for managing account changes"
-                }
+                },
+                "keywords": ("account", "provision", "disable", "remov", "deactivat")
             },
             "AC-2(G)": {
                 "title": "Account monitoring",
@@ -153,7 +210,8 @@ NIST_CONTROLS = {
                 "assessment_criteria": {
                     "monitoring_processes": "Look for evidence of account usage monitoring",
                     "oversight_mechanisms": "Procedures for tracking account activity"
-                }
+                },
+                "keywords": ("monitor", "audit", "logging", "track")
             },
             "AC-2(H)(a)": {
                 "title": "Notification - accounts no longer required",
@@ -161,7 +219,8 @@ NIST_CONTROLS = {
                 "assessment_criteria": {
                     "notification_process": "Look for procedures to notify managers about unneeded accounts",
                     "account_cleanup": "Evidence of processes to identify and remove unused accounts"
-                }
+                },
+                "keywords": ("notif", "inactive", "unused", "dormant", "no longer")
             },
             "AC-2(H)(b)": {
                 "title": "Notification - user termination/transfer",
@@ -169,7 +228,8 @@ NIST_CONTROLS = {
                 "assessment_criteria": {
                     "termination_notification": "Look for procedures to notify when users leave",
                     "transfer_notification": "Evidence of notification when users change roles"
-                }
+                },
+                "keywords": ("terminat", "transfer", "separat", "offboard", "leav")
             },
             "AC-2(H)(c)": {
                 "title": "Notification - usage/need-to-know changes",
@@ -177,7 +237,8 @@ NIST_CONTROLS = {
                 "assessment_criteria": {
                     "usage_change_notification": "Look for procedures to notify about changing access needs",
                     "need_to_know_updates": "Evidence of communication about access requirement changes"
-                }
+                },
+                "keywords": ("need-to-know", "need to know", "notif", "change")
             },
             "AC-2(I)(a)": {
                 "title": "Authorization - valid access",
@@ -185,7 +246,8 @@ NIST_CONTROLS = {
                 "assessment_criteria": {
                     "authorization_requirement": "Look for requirement of valid authorization before access",
                     "approval_documentation": "Evidence of formal authorization processes"
-                }
+                },
+                "keywords": ("authoriz", "authoris", "approv")
             },
             "AC-2(I)(b)": {
                 "title": "Authorization - intended usage",
@@ -193,7 +255,8 @@ NIST_CONTROLS = {
                 "assessment_criteria": {
                     "usage_based_access": "Look for access tied to intended use of systems",
                     "purpose_alignment": "Evidence that access matches job requirements"
-                }
+                },
+                "keywords": ("intended use", "usage", "job", "business need", "purpose")
             },
             "AC-2(I)(c)": {
                 "title": "Authorization - other attributes",
@@ -201,7 +264,8 @@ NIST_CONTROLS = {
                 "assessment_criteria": {
                     "attribute_based_access": "Look for access based on other organizational attributes",
                     "business_function_alignment": "Evidence of access tied to business needs"
-                }
+                },
+                "keywords": ("attribute", "business function", "mission", "authoriz", "authoris")
             },
             "AC-2(J)": {
                 "title": "Annual account review",
@@ -209,7 +273,8 @@ NIST_CONTROLS = {
                 "assessment_criteria": {
                     "regular_review": "Look for evidence of periodic account reviews",
                     "annual_frequency": "Reviews happening at least once per year"
-                }
+                },
+                "keywords": ("review", "recertif", "attest", "annual")
             },
             "AC-2(K)": {
                 "title": "Shared account credential reissuance",
@@ -217,7 +282,8 @@ NIST_CONTROLS = {
                 "assessment_criteria": {
                     "credential_reissuance": "Look for procedures to change shared credentials when users leave",
                     "shared_account_management": "Evidence of processes for managing group accounts"
-                }
+                },
+                "keywords": ("shared", "group account", "generic account", "credential", "password")
             }
         }
     },
@@ -234,57 +300,151 @@ NIST_CONTROLS = {
                     "system_implementation": "Evidence of actual system configurations, not just policy statements",
                     "authorization_verification": "Proof that systems check authorizations before granting access",
                     "policy_alignment": "Evidence that technical controls match stated policies"
-                }
+                },
+                "keywords": ("access control", "enforce", "authoriz", "authoris", "permission", "role-based")
             }
         }
     }
 }
 
-def create_pattern_based_prompt(sub_id, sub_info, control_info, document_text, current_date):
-    """Create assessment prompt incorporating pattern-based evidence requirements"""
-    
-    # Determine evidence requirements based on control definition
-    evidence_req = determine_evidence_requirements(sub_info['definition'])
-    
-    base_prompt = f"""
-Today's date is {current_date}.
+# Structured-output schema for sub-requirement assessments. In strict mode the
+# service guarantees these field types and status values, so parsed results are
+# used as-is without further coercion.
+AI_RESULT_SCHEMA = {
+    "name": "sub_requirement_assessment",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "evidence": {"type": "string"},
+            "status": {"type": "string", "enum": ["Fully Meets", "Partially Meets", "Does Not Meet"]},
+            "confidence": {"type": "number"},
+            "assessment_reasoning": {"type": "string"},
+            "evidence_type_analysis": {"type": "string"}
+        },
+        "required": ["evidence", "status", "confidence", "assessment_reasoning", "evidence_type_analysis"],
+        "additionalProperties": False
+    }
+}
 
-COMPLIANCE ASSESSMENT for {sub_id}: {sub_info['title']}
+# Structured-output schema for a batched call covering several sub-requirements of
+# one control; each entry carries the sub_id it answers plus the single-result fields
+AI_BATCH_RESULT_SCHEMA = {
+    "name": "control_assessment_batch",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "results": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "sub_id": {"type": "string"},
+                        **AI_RESULT_SCHEMA["schema"]["properties"]
+                    },
+                    "required": ["sub_id", *AI_RESULT_SCHEMA["schema"]["required"]],
+                    "additionalProperties": False
+                }
+            }
+        },
+        "required": ["results"],
+        "additionalProperties": False
+    }
+}
 
-Sub-requirement definition: {sub_info['definition']}
+# Typed views of the two schemas above. Decoding straight into these validates
+# syntax, field presence, types and the status enum in one C-level pass. Fields are
+# keyword-only, and gc=False keeps these short-lived, cycle-free instances out of
+# the cyclic garbage collector.
+class AiAssessment(msgspec.Struct, kw_only=True, gc=False):
+    evidence: str
+    status: Literal['Fully Meets', 'Partially Meets', 'Does Not Meet']
+    confidence: float
+    assessment_reasoning: str
+    evidence_type_analysis: str
 
-PATTERN-BASED ASSESSMENT RULES:
-Control Type: {evidence_req['type']}
-Reasoning: {evidence_req['reasoning']}
-Policy Document Maximum Score: {evidence_req['policy_max_score']}
-Required Evidence Types: {', '.join(evidence_req['full_compliance_requires'])}
-Evidence Examples: {evidence_req.get('evidence_examples', 'Various forms of supporting documentation')}
+class AiBatchAssessment(AiAssessment):
+    sub_id: str
 
-"""
+class _AiBatchReply(msgspec.Struct, gc=False):
+    # Entries stay raw so one malformed entry does not discard the rest of the batch
+    results: list[msgspec.Raw]
 
-    # Add assessment note if present
-    if 'assessment_note' in evidence_req:
-        base_prompt += f"Special Note: {evidence_req['assessment_note']}\n\n"
+_ASSESSMENT_DECODER = msgspec.json.Decoder(AiAssessment)
+_BATCH_DECODER = msgspec.json.Decoder(_AiBatchReply)
+_BATCH_ENTRY_DECODER = msgspec.json.Decoder(AiBatchAssessment)
 
-    # Get assessment criteria if available
-    criteria = sub_info.get('assessment_criteria', {})
+# Words of four or more characters, used for the definition/document overlap pre-filter
+_WORD_RE = re.compile(r"\w{4,}")
+
+# Control definitions are static, so classify each sub-requirement's evidence needs
+# and tokenize its definition once at import
+for control_info in NIST_CONTROLS.values():
+    for sub_info in control_info['sub_requirements'].values():
+        sub_info['_evidence_req'] = determine_evidence_requirements(sub_info['definition'])
+        sub_info['_definition_words'] = frozenset(_WORD_RE.findall(sub_info['definition'].lower()))
+
+# Flattened (control_id, control_info, sub_id, sub_info) view of NIST_CONTROLS,
+# built once at import so the handler walks a single list instead of nested dicts
+_FLAT_SUB_REQUIREMENTS = [
+    (control_id, control_info, sub_id, sub_info)
+    for control_id, control_info in NIST_CONTROLS.items()
+    for sub_id, sub_info in control_info['sub_requirements'].items()
+]
+
+# Whitespace clean-up applied once to extracted text, before it is cached or tokenized.
+# PDFium reports line breaks as \r\n, so line endings are unified before the other passes.
+_LINE_BREAK_RE = re.compile(r'\r\n?')
+_HSPACE_RE = re.compile(r'[ \t\f\v\xa0]+')
+_TRAILING_SPACE_RE = re.compile(r' *\n *')
+_BLANK_LINES_RE = re.compile(r'\n{3,}')
+
+def normalize_document_text(text_content):
+    """Unify line breaks, collapse runs of spaces, strip line-edge spaces and squeeze blank lines in extracted text"""
+    text_content = _LINE_BREAK_RE.sub('\n', text_content)
+    text_content = _HSPACE_RE.sub(' ', text_content)
+    text_content = _TRAILING_SPACE_RE.sub('\n', text_content)
+    return _BLANK_LINES_RE.sub('\n\n', text_content)
+
+# Token budget for the document excerpt every assessment prompt shares
+DOCUMENT_TOKEN_LIMIT = 3500
+
+@functools.lru_cache(maxsize=None)
+def _get_encoding():
+    """Load the tokenizer once per worker (o200k_base is the gpt-4o family encoding)"""
+    return tiktoken.get_encoding("o200k_base")
+
+def truncate_document(text_content):
+    """Cut extracted text to the first DOCUMENT_TOKEN_LIMIT tokens, returning the canonical excerpt"""
+    encoding = _get_encoding()
+    # Text averages ~4 characters per token; pre-slicing at 32 bounds encode work on long documents
+    head = text_content[:DOCUMENT_TOKEN_LIMIT * 32]
+    tokens = encoding.encode(head, disallowed_special=())
+    if len(tokens) <= DOCUMENT_TOKEN_LIMIT:
+        return head
+    return encoding.decode(tokens[:DOCUMENT_TOKEN_LIMIT])
+
+def build_document_prefix(document_text, current_date):
+    """
+    Build the prompt opening shared by every sub-requirement of one document.
     
-    if criteria:
-        base_prompt += f"SPECIFIC CRITERIA TO CHECK:\n"
-        for criterion, description in criteria.items():
-            base_prompt += f"• {criterion.upper()}: {description}\n"
-        base_prompt += "\n"
+    Everything invariant for the request (date, instructions, document excerpt,
+    response format) comes first so Azure OpenAI prompt caching can reuse the
+    prefix across the sub-requirement calls; only the requirement itself varies.
+    """
+    return f"""
+Today's date is {current_date}.
 
-    base_prompt += f"""
 ASSESSMENT INSTRUCTIONS:
-1. Analyze the document systematically for evidence related to this requirement
+1. Analyze the document systematically for evidence related to the requirement given after the document
 2. Consider the control type when determining compliance level
 3. For technical controls: Policy alone = maximum "Partially Meets"
 4. For organizational controls: Policy/procedures can achieve "Fully Meets"
 5. Quote specific evidence from the document
 
 DOCUMENT TO ANALYZE:
-{document_text[:8000]}
+{document_text}
 
 REQUIRED JSON RESPONSE:
 {{
@@ -297,54 +457,569 @@ REQUIRED JSON RESPONSE:
 
 Remember: Apply pattern-based rules consistently. Technical implementation controls require more than policy evidence for full compliance.
 """
+
+def _make_sub_section_builder(evidence_req):
+    """
+    Specialize the sub-requirement prompt section for one evidence profile.
+    
+    The profile's rules block (and special note, for the mixed profile) is
+    rendered once here, so the returned builder only fills in per-sub text.
+    """
+    rules = f"""PATTERN-BASED ASSESSMENT RULES:
+Control Type: {evidence_req['type']}
+Reasoning: {evidence_req['reasoning']}
+Policy Document Maximum Score: {evidence_req['policy_max_score']}
+Required Evidence Types: {', '.join(evidence_req['full_compliance_requires'])}
+Evidence Examples: {evidence_req.get('evidence_examples', 'Various forms of supporting documentation')}
+
+"""
+    if 'assessment_note' in evidence_req:
+        rules += f"Special Note: {evidence_req['assessment_note']}\n\n"
+
+    def build_sub_section(sub_id, sub_info, criteria):
+        """Build the sub-requirement-specific closing of an assessment prompt"""
+        parts = [f"""
+COMPLIANCE ASSESSMENT for {sub_id}: {sub_info['title']}
+
+Sub-requirement definition: {sub_info['definition']}
+
+""", rules]
+
+        if criteria:
+            parts.append("SPECIFIC CRITERIA TO CHECK:\n")
+            parts.extend(f"• {criterion.upper()}: {description}\n" for criterion, description in criteria.items())
+            parts.append("\n")
+        
+        return "".join(parts)
+    
+    return build_sub_section
+
+# Prompt section builder per evidence profile type
+_PROMPT_BUILDERS = {
+    profile['type']: _make_sub_section_builder(profile)
+    for profile in (_EVIDENCE_REQ_TECH, _EVIDENCE_REQ_ORG, _EVIDENCE_REQ_MIXED)
+}
+
+def create_pattern_based_prompt(sub_id, sub_info, control_info, document_prefix):
+    """Create assessment prompt incorporating pattern-based evidence requirements"""
+    
+    # Evidence requirements are precomputed from the definition at import
+    build_sub_section = _PROMPT_BUILDERS[sub_info['_evidence_req']['type']]
+    criteria = sub_info.get('assessment_criteria', {})
+    
+    return "".join([document_prefix, build_sub_section(sub_id, sub_info, criteria)])
+
+def create_control_batch_prompt(control_id, control_info, sub_items, document_prefix):
+    """
+    Create one prompt assessing several sub-requirements of a control together.
+    
+    sub_items is a list of (sub_id, sub_info) pairs. The document prefix is the
+    same one the single-requirement prompts use, so the document is sent once
+    per control and the cached prefix is shared with any per-sub fallback calls.
+    """
+    parts = [document_prefix, f"""
+BATCH ASSESSMENT for control {control_id}: {control_info['title']}
+
+Assess each of the {len(sub_items)} sub-requirements below independently. Return a JSON object with a "results" array containing one entry per sub-requirement, each with its "sub_id" plus the fields of the required JSON response.
+"""]
+    for sub_id, sub_info in sub_items:
+        build_sub_section = _PROMPT_BUILDERS[sub_info['_evidence_req']['type']]
+        parts.append(build_sub_section(sub_id, sub_info, sub_info.get('assessment_criteria', {})))
+    
+    return "".join(parts)
+
+# Sent unchanged with every call so the cached prompt prefix starts at the system message
+SYSTEM_PROMPT = "You are a NIST compliance expert who applies pattern-based assessment rules consistently. Always consider control type when determining maximum possible compliance level."
+
+# Assessed status values. Parsed statuses are interned onto these objects, so the
+# rollup's equality checks against them resolve on identity
+_STATUS_FULLY = sys.intern('Fully Meets')
+_STATUS_PARTIAL = sys.intern('Partially Meets')
+_STATUS_NONE = sys.intern('Does Not Meet')
+
+# Fields every Error sub_result shares; the key order matches a normal sub_result
+FALLBACK_SUB_TEMPLATE = MappingProxyType({
+    "sub_id": None,
+    "title": None,
+    "definition": None,
+    "evidence": None,
+    "status": "Error",
+    "confidence": 0.0,
+    "assessment_reasoning": None,
+    "evidence_type_analysis": "Error in processing"
+})
+
+def _error_sub_result(sub_id, sub_info, evidence, reasoning):
+    """Build the fallback sub_result recorded when a sub-requirement cannot be assessed"""
+    return {
+        **FALLBACK_SUB_TEMPLATE,
+        "sub_id": sub_id,
+        "title": sub_info['title'],
+        "definition": sub_info['definition'],
+        "evidence": evidence,
+        "assessment_reasoning": reasoning
+    }
+
+# Local pre-filters: a sub-requirement is sent for AI assessment only if the document
+# excerpt contains at least KEYWORD_MIN_HITS of its keywords and shares at least
+# MIN_DEFINITION_OVERLAP words with its definition; otherwise it is scored as not met
+KEYWORD_MIN_HITS = 1
+MIN_DEFINITION_OVERLAP = 2
+
+_NO_KEYWORDS_REASONING = "No relevant terms found in document; assessed locally without AI review"
+_NO_OVERLAP_REASONING = "Pre-filter: insufficient word overlap between document and requirement definition; assessed locally without AI review"
+
+def _prescreened_sub_result(sub_id, sub_info, reasoning):
+    """Build the low-confidence sub_result for a sub-requirement a local pre-filter ruled out"""
+    return {
+        "sub_id": sub_id,
+        "title": sub_info['title'],
+        "definition": sub_info['definition'],
+        "evidence": "No evidence found",
+        "status": _STATUS_NONE,
+        "confidence": 0.1,
+        "assessment_reasoning": reasoning,
+        "evidence_type_analysis": "None"
+    }
+
+def _json_payload(response_text):
+    """Cut a reply down to its outermost {...} span, dropping any prose or code fence around it"""
+    start = response_text.find('{')
+    end = response_text.rfind('}')
+    if start == -1 or end <= start or (start == 0 and end == len(response_text) - 1):
+        return response_text
+    return response_text[start:end + 1]
+
+def _validate_ai_result(response_text, sub_id, sub_info):
+    """
+    Parse and check an AI response for one sub-requirement.
+    
+    Returns either a populated sub_result or an Error sub_result; nothing is
+    raised for malformed responses, so the caller needs no parsing handlers.
+    """
+    # Structured outputs normally return bare JSON; trimming first recovers a wrapped
+    # reply without a failed decode. msgspec reports syntax and shape errors alike as
+    # DecodeError, with the field path.
+    try:
+        ai_result = _ASSESSMENT_DECODER.decode(_json_payload(response_text))
+    except msgspec.DecodeError as decode_err:
+        logging.error("  → AI response for %s failed validation: %s", sub_id, decode_err)
+        # The raw excerpt is only sliced and formatted when debug output is actually on
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("  → Raw response: %s...", response_text[:200])
+        return _error_sub_result(sub_id, sub_info, f"AI response parsing error: {str(decode_err)[:100]}", "Response validation failed")
+    
+    return _assessment_sub_result(ai_result, sub_id, sub_info)
+
+def _assessment_sub_result(ai_result, sub_id, sub_info):
+    """Build the sub_result for a validated AiAssessment"""
+    status = sys.intern(ai_result.status)
+    logging.info("  → %s assessed as: %s (confidence: %.2f)", sub_id, status, ai_result.confidence)
+    return {
+        "sub_id": sub_id,
+        "title": sub_info['title'],
+        "definition": sub_info['definition'],
+        "evidence": ai_result.evidence,
+        "status": status,
+        "confidence": ai_result.confidence,
+        "assessment_reasoning": ai_result.assessment_reasoning,
+        "evidence_type_analysis": ai_result.evidence_type_analysis
+    }
+
+# In-process LRU caches; they live as long as the worker and are only touched from
+# the event loop thread. Extracted text is keyed by the SHA-256 of the uploaded PDF
+# bytes; assessments are keyed by the content the model actually sees, so the same
+# text re-exported or re-uploaded as a different file still hits.
+TEXT_CACHE_SIZE = 32
+ASSESSMENT_CACHE_SIZE = 1024
+_text_cache = OrderedDict()  # doc_hash -> (text_content, page_count)
+_assessment_cache = OrderedDict()  # (sub_id, evidence_key) -> sub_result
+
+def evidence_cache_key(doc_slice, current_date):
+    """Content hash of everything document-specific in a prompt: the excerpt and the date it is assessed on"""
+    return hashlib.blake2b(f"{current_date}|{doc_slice}".encode(), digest_size=16).hexdigest()
+
+def _cache_get(cache, key):
+    """Return the cached value for key (marking it most recently used), or None"""
+    value = cache.get(key)
+    if value is not None:
+        cache.move_to_end(key)
+    return value
+
+def _cache_put(cache, key, value, max_size):
+    """Store value under key, evicting the least recently used entry past max_size"""
+    cache[key] = value
+    cache.move_to_end(key)
+    if len(cache) > max_size:
+        cache.popitem(last=False)
+
+# Upper bound on concurrent Azure OpenAI calls per request
+MAX_CONCURRENT_ASSESSMENTS = 8
+
+# Completion budget per sub-requirement; batched calls scale it by the batch size. A
+# complete assessment (quotes, reasoning, evidence types) runs to roughly 200-350
+# tokens, so this bounds pathological replies while leaving headroom for long quotes.
+MAX_TOKENS_PER_SUB = 600
+
+# Most sub-requirements sent in one batched call. Larger controls are split so replies
+# stay well inside the completion limit and one bad reply costs fewer retries.
+MAX_BATCH_SIZE = 8
+
+async def _assess_sub(client, deployment, limiter, sub_id, sub_info, control_info, document_prefix):
+    """Assess one sub-requirement with Azure OpenAI, returning its sub_result (Error result on failure)"""
+    logging.info("  → Analyzing sub-requirement %s", sub_id)
     
-    return base_prompt
+    try:
+        # Create pattern-based prompt
+        prompt = create_pattern_based_prompt(sub_id, sub_info, control_info, document_prefix)
+        
+        logging.info("  → Calling Azure OpenAI for %s", sub_id)
+        
+        # Call Azure OpenAI for sub-requirement
+        async with limiter:
+            ai_response = await client.chat.completions.create(
+                model=deployment,
+                messages=[
+                    {"role": "system", "content": SYSTEM_PROMPT},
+                    {"role": "user", "content": prompt}
+                ],
+                max_tokens=MAX_TOKENS_PER_SUB,
+                temperature=0.1,
+                response_format={"type": "json_schema", "json_schema": AI_RESULT_SCHEMA}
+            )
+        
+        choice = ai_response.choices[0]
+        if choice.finish_reason == 'length':
+            logging.warning("  → Reply for %s hit the %d token cap", sub_id, MAX_TOKENS_PER_SUB)
+        return _validate_ai_result(choice.message.content, sub_id, sub_info)
+        
+    except Exception as sub_error:
+        logging.error("  → Error processing sub-requirement %s: %s", sub_id, sub_error)
+        return _error_sub_result(sub_id, sub_info, f"Processing error: {str(sub_error)[:100]}", "Processing error occurred")
+
+def chunked(items, size):
+    """Split a list into consecutive slices of at most size items"""
+    return [items[i:i + size] for i in range(0, len(items), size)]
 
-def calculate_overall_control_status(sub_results):
-    """Calculate overall control status with enhanced logic"""
-    if not sub_results:
-        return "Does Not Meet"
+async def _assess_control(client, deployment, limiter, control_id, control_info, sub_items, document_prefix):
+    """
+    Assess a batch of sub-requirements of one control with a single Azure OpenAI call.
     
-    valid_results = [r for r in sub_results if r['status'] not in ['Error']]
-    if not valid_results:
-        return "Does Not Meet"
+    Returns {sub_id: sub_result}. When a reply arrives, sub-requirements it leaves
+    out or answers malformed are retried individually with _assess_sub. When the
+    call itself fails (timeout, throttling, service error after the SDK's retries),
+    every sub-requirement gets an Error result instead, so a struggling service is
+    not hit with one extra call per sub-requirement. Every call holds limiter, the
+    request's semaphore, while it is in flight.
+    """
+    logging.info("  → Calling Azure OpenAI for %s (%d sub-requirements)", control_id, len(sub_items))
+    
+    try:
+        prompt = create_control_batch_prompt(control_id, control_info, sub_items, document_prefix)
+        
+        async with limiter:
+            ai_response = await client.chat.completions.create(
+                model=deployment,
+                messages=[
+                    {"role": "system", "content": SYSTEM_PROMPT},
+                    {"role": "user", "content": prompt}
+                ],
+                max_tokens=MAX_TOKENS_PER_SUB * len(sub_items),
+                temperature=0.1,
+                response_format={"type": "json_schema", "json_schema": AI_BATCH_RESULT_SCHEMA}
+            )
+    
+    except Exception as batch_error:
+        logging.error("  → Batched assessment failed for %s: %s", control_id, batch_error)
+        return {
+            sub_id: _error_sub_result(sub_id, sub_info, f"Processing error: {str(batch_error)[:100]}", "Processing error occurred")
+            for sub_id, sub_info in sub_items
+        }
     
-    total = len(valid_results)
-    fully_meets = sum(1 for r in valid_results if r['status'] == 'Fully Meets')
-    partially_meets = sum(1 for r in valid_results if r['status'] == 'Partially Meets') 
-    does_not_meet = sum(1 for r in valid_results if r['status'] == 'Does Not Meet')
+    choice = ai_response.choices[0]
+    if choice.finish_reason == 'length':
+        logging.warning("  → Batched reply for %s hit the %d token cap", control_id, MAX_TOKENS_PER_SUB * len(sub_items))
+    
+    sub_results = {}
+    try:
+        batch = _BATCH_DECODER.decode(_json_payload(choice.message.content))
+    except msgspec.DecodeError as decode_err:
+        logging.error("  → Batched reply for %s failed validation: %s", control_id, decode_err)
+    else:
+        requested = dict(sub_items)
+        for raw_entry in batch.results:
+            try:
+                ai_result = _BATCH_ENTRY_DECODER.decode(raw_entry)
+            except msgspec.ValidationError as entry_err:
+                logging.error("  → Batched entry for %s failed validation: %s", control_id, entry_err)
+                continue
+            sub_id = ai_result.sub_id
+            if sub_id in requested and sub_id not in sub_results:
+                sub_results[sub_id] = _assessment_sub_result(ai_result, sub_id, requested[sub_id])
+    
+    # A reply arrived but did not cover everything: retry the gaps with concurrent per-sub calls
+    missing = [(sub_id, sub_info) for sub_id, sub_info in sub_items if sub_id not in sub_results]
+    if missing:
+        logging.warning("  → %d sub-requirements missing or malformed in batched reply for %s, assessing individually", len(missing), control_id)
+        retried = await asyncio.gather(*(
+            _assess_sub(client, deployment, limiter, sub_id, sub_info, control_info, document_prefix)
+            for sub_id, sub_info in missing
+        ))
+        for (sub_id, _), sub_result in zip(missing, retried):
+            sub_results[sub_id] = sub_result
+    
+    return sub_results
+
+# Confidence weight per assessed status (fully meets = higher weight); Error results are excluded
+_STATUS_CONFIDENCE_WEIGHTS = {_STATUS_FULLY: 1.2, _STATUS_PARTIAL: 1.0, _STATUS_NONE: 0.8}
+
+def calculate_overall_control_result(sub_results):
+    """Calculate overall control status and weighted average confidence in a single pass"""
+    total = fully_meets = does_not_meet = 0
+    weighted_sum = total_weight = 0.0
+    
+    for r in sub_results:
+        status = r['status']
+        weight = _STATUS_CONFIDENCE_WEIGHTS.get(status)
+        if weight is None:
+            continue
+        total += 1
+        if status == _STATUS_FULLY:
+            fully_meets += 1
+        elif status == _STATUS_NONE:
+            does_not_meet += 1
+        weighted_sum += r['confidence'] * weight
+        total_weight += weight
+    
+    if not total:
+        return _STATUS_NONE, 0.0
     
     # Enhanced assessment logic
     if does_not_meet == 0 and fully_meets >= total * 0.8:  # 80% fully meet
-        return "Fully Meets"
+        status = _STATUS_FULLY
     elif does_not_meet > total * 0.5:  # Majority don't meet
-        return "Does Not Meet"
+        status = _STATUS_NONE
     else:
-        return "Partially Meets"
-
-def calculate_overall_confidence(sub_results):
-    """Calculate weighted average confidence"""
-    valid_results = [r for r in sub_results if r['status'] not in ['Error']]
-    if not valid_results:
-        return 0.0
-    
-    # Weight confidence by status (fully meets = higher weight)
-    weighted_sum = 0
-    total_weight = 0
-    
-    for r in valid_results:
-        weight = 1.0
-        if r['status'] == 'Fully Meets':
-            weight = 1.2
-        elif r['status'] == 'Does Not Meet':
-            weight = 0.8
-            
-        weighted_sum += r['confidence'] * weight
-        total_weight += weight
+        status = _STATUS_PARTIAL
+    
+    return status, weighted_sum / total_weight
+
+# Catalog text repeated in every result; ?include=minimal leaves it out for clients
+# that already hold the catalog and join on control_id / sub_id
+_CATALOG_FIELDS = frozenset(("title", "definition"))
+
+def without_catalog_fields(result):
+    """Copy of a control or sub-requirement result without its catalog title and definition"""
+    return {key: value for key, value in result.items() if key not in _CATALOG_FIELDS}
+
+def _hash_stream(stream):
+    """SHA-256 a seekable file-like object in 1 MiB chunks, then rewind it. Returns (hexdigest, size)."""
+    digest = hashlib.sha256()
+    size = 0
+    while chunk := stream.read(1 << 20):
+        digest.update(chunk)
+        size += len(chunk)
+    stream.seek(0)
+    return digest.hexdigest(), size
+
+# PDFium is not thread-safe, not even across separate documents, and extraction runs in
+# the default executor, where concurrent invocations on this worker can overlap. Every
+# PDFium call, including closing its handles, happens under this lock.
+_PDFIUM_LOCK = threading.Lock()
+
+def _extract_pdf_text(pdf_stream):
+    """
+    Extract page-tagged text from a seekable PDF file object.
+    
+    Both readers consume the upload stream directly, so the PDF is never copied
+    into a separate bytes buffer. Uses PDFium's native text extraction, falling
+    back to PyPDF2 for documents PDFium cannot open. Kept free of request state
+    so it can be handed to an executor and run off the request thread.
+    Returns (text_content, page_count).
+    """
+    with _PDFIUM_LOCK:
+        try:
+            pdf = pdfium.PdfDocument(pdf_stream)
+        except pdfium.PdfiumError as pdfium_err:
+            pdf = None
+            logging.warning("PDFium could not open document (%s), falling back to PyPDF2", pdfium_err)
+        
+        if pdf is not None:
+            try:
+                # Pages stay serial, and page handles are closed here rather than left to the
+                # garbage collector, which could finalize them on another thread outside the lock
+                parts = []
+                for page_num in range(len(pdf)):
+                    page = pdf[page_num]
+                    textpage = page.get_textpage()
+                    parts.append(f"\n--- Page {page_num + 1} ---\n{textpage.get_text_range()}")
+                    textpage.close()
+                    page.close()
+                return "".join(parts), len(pdf)
+            finally:
+                pdf.close()
+    
+    # PyPDF2 is pure Python and only reads this request's stream, so it runs outside the lock
+    pdf_stream.seek(0)
+    return _extract_pdf_text_pypdf2(pdf_stream)
+
+def _prepare_document(pdf_stream, extracted):
+    """
+    Do all of a request's CPU-bound document work in one executor hop.
+    
+    Extracts and normalizes the PDF unless extracted (text_content, page_count)
+    was served from the text cache, then cuts the prompt excerpt and derives the
+    lowercase text and word set the pre-filters scan. Returns
+    (extracted, doc_slice, doc_slice_lower, doc_words).
+    """
+    if extracted is None:
+        text_content, page_count = _extract_pdf_text(pdf_stream)
+        # Layout whitespace carries no meaning for the assessment but costs tokens in every prompt
+        extracted = (normalize_document_text(text_content), page_count)
+    doc_slice = truncate_document(extracted[0])
+    doc_slice_lower = doc_slice.lower()
+    return extracted, doc_slice, doc_slice_lower, set(_WORD_RE.findall(doc_slice_lower))
+
+def _extract_pdf_text_pypdf2(pdf_stream):
+    """Pure-Python extraction used when PDFium rejects a document. Returns (text_content, page_count)."""
+    reader = PdfReader(pdf_stream)
+    
+    # Pages are extracted serially: they share the reader's underlying stream
+    text_content = "".join(
+        f"\n--- Page {page_num + 1} ---\n{page.extract_text()}"
+        for page_num, page in enumerate(reader.pages)
+    )
+    
+    return text_content, len(reader.pages)
+
+# fuzz.ratio score at or above which two evidence quotes count as duplicates
+EVIDENCE_SIMILARITY_THRESHOLD = 85
+
+def deduplicate_evidence(evidence_pieces, limit=2):
+    """Keep the first `limit` evidence quotes that are not near-duplicates of one already kept"""
+    unique = []
+    for piece in evidence_pieces:
+        if all(fuzz.ratio(piece, kept) < EVIDENCE_SIMILARITY_THRESHOLD for kept in unique):
+            unique.append(piece)
+            if len(unique) == limit:
+                break
+    return unique
+
+# Bodies below this size are sent uncompressed; encoding overhead outweighs the savings
+COMPRESSION_MIN_BYTES = 1024
+
+def _accepted_encodings(accept_encoding):
+    """Content codings named in an Accept-Encoding header, minus any refused with q=0"""
+    encodings = set()
+    for part in accept_encoding.lower().split(','):
+        coding, _, params = part.partition(';')
+        q = params.replace(' ', '').removeprefix('q=')
+        if q and not q.strip('0.'):  # q=0, q=0.0, ... mark the coding as not acceptable
+            continue
+        encodings.add(coding.strip())
+    return encodings
+
+def _compress_body(body, accept_encoding):
+    """
+    Compress a response body with the best coding the client accepts.
+    
+    Returns (body, headers). Brotli is preferred when installed, then gzip;
+    small bodies and clients accepting neither get the body unchanged.
+    """
+    headers = {"Vary": "Accept-Encoding"}
+    if len(body) < COMPRESSION_MIN_BYTES:
+        return body, headers
     
-    return weighted_sum / total_weight
+    encodings = _accepted_encodings(accept_encoding)
+    if brotli is not None and 'br' in encodings:
+        headers["Content-Encoding"] = "br"
+        return brotli.compress(body, quality=4), headers
+    if 'gzip' in encodings:
+        headers["Content-Encoding"] = "gzip"
+        return gzip.compress(body, compresslevel=5), headers
+    return body, headers
+
+def _error_response(body):
+    """Wrap a JSON error body (bytes, so the worker skips its own encode) in the standard 500 response"""
+    return _HttpResponse(body, status_code=500, mimetype="application/json", headers=_ERROR_HEADERS)
+
+# Exception class -> name, filled on first sight of each class reaching the error handler
+_EXC_NAMES: dict[type, str] = {}
+
+# Fixed-shape error body up to the timestamp value, for messages needing no JSON escaping
+_ERR_TEMPLATE = b'{"error":"%s","error_type":"%s","timestamp":'
+
+@functools.lru_cache(maxsize=256)
+def _build_error_bytes(err_type, msg):
+    """Encode the error body up to the timestamp value, which is appended per response"""
+    if msg.isascii() and msg.isprintable() and '"' not in msg and '\\' not in msg and err_type.isascii():
+        # Nothing to escape: fill the template instead of running an encoder
+        return _ERR_TEMPLATE % (msg.encode(), err_type.encode())
+    
+    return _dumps({"error": msg, "error_type": err_type})[:-1] + b',"timestamp":'
+
+def _build_error_response(e):
+    """Build the 500 JSON response for an exception raised while processing a request"""
+    # The frontend prefixes "Error processing document: " itself, so send the bare message
+    # A lone string argument is the message itself; multi-argument exceptions such as
+    # OSError or UnicodeDecodeError only format a readable message through str()
+    if len(e.args) == 1 and isinstance(e.args[0], str):
+        msg = e.args[0]
+    else:
+        msg = str(e)
+    cls = type(e)
+    err_type = _EXC_NAMES.get(cls) or _EXC_NAMES.setdefault(cls, cls.__name__)
+    return _error_response(_build_error_bytes(err_type, msg) + repr(time.time()).encode() + b"}")
+
+# Client transport settings. The SDK default of 2 retries with backoff is kept
+# explicit. Reads may wait up to 90 s because a batched reply covers up to
+# MAX_BATCH_SIZE sub-requirements; connects should fail fast. The pool is sized for
+# several concurrent invocations sharing this worker's client.
+OPENAI_MAX_RETRIES = 2
+OPENAI_TIMEOUT = httpx.Timeout(90.0, connect=5.0)
+OPENAI_POOL_LIMITS = httpx.Limits(max_connections=64, max_keepalive_connections=32)
+
+# Worker-wide Azure OpenAI client; created on first use and reused across invocations
+_client = None
+_client_lock = threading.Lock()
+
+def get_client():
+    """Return the shared async Azure OpenAI client, creating it from the environment on first call"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                logging.info('Initializing Azure OpenAI client...')
+                _client = AsyncAzureOpenAI(
+                    api_version=os.environ.get('AZURE_OPENAI_API_VERSION'),
+                    azure_endpoint=os.environ.get('AZURE_OPENAI_ENDPOINT'),
+                    api_key=os.environ.get('AZURE_OPENAI_KEY'),
+                    max_retries=OPENAI_MAX_RETRIES,
+                    timeout=OPENAI_TIMEOUT,
+                    http_client=DefaultAsyncHttpxClient(limits=OPENAI_POOL_LIMITS)
+                )
+    return _client
 
-# Warmup endpoint to prevent cold starts
+def _preload():
+    """Build the client and load the tokenizer during worker import rather than on the first request"""
+    # Nothing here may raise: a failed import registers no functions at all, not even
+    # /warmup, which exists to report incomplete configuration
+    if os.environ.get('AZURE_OPENAI_ENDPOINT') and os.environ.get('AZURE_OPENAI_KEY'):
+        try:
+            get_client()
+        except Exception as e:  # e.g. AZURE_OPENAI_API_VERSION unset
+            logging.warning("Client preload failed, it will be built on first request: %s", e)
+    # tiktoken may fetch its encoding file on first use
+    try:
+        _get_encoding()
+    except Exception as e:
+        logging.warning("Tokenizer preload failed, it will load on first request: %s", e)
+
+_preload()
+
+# Warmup endpoint to prevent cold starts. This app deploys as a Static Web Apps managed
+# API, which only supports HTTP triggers, so keeping instances warm is left to an
+# external pinger hitting GET /warmup rather than a timer or warmup trigger.
 @app.route(route="warmup", auth_level=func.AuthLevel.ANONYMOUS, methods=["GET"])
 def warmup(req: func.HttpRequest) -> func.HttpResponse:
     """Simple warmup endpoint to keep function active"""
@@ -357,46 +1032,41 @@ def warmup(req: func.HttpRequest) -> func.HttpResponse:
         api_key = os.environ.get('AZURE_OPENAI_KEY')
         deployment = os.environ.get('AZURE_OPENAI_DEPLOYMENT')
         
+        # Create the shared client now so the first real request finds a ready connection pool
+        if endpoint and api_key:
+            get_client()
+        
         warmup_response = {
             "status": "warm",
-            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "timestamp": datetime.now(_UTC).isoformat(),
             "environment_check": {
                 "endpoint_configured": bool(endpoint),
                 "api_key_configured": bool(api_key),
-                "deployment_configured": bool(deployment)
+                "deployment_configured": bool(deployment),
+                "client_ready": _client is not None
             }
         }
         
         return func.HttpResponse(
-            json.dumps(warmup_response),
+            _dumps(warmup_response),
             status_code=200,
-            mimetype="application/json",
-            headers={
-                "Access-Control-Allow-Origin": "*",
-                "Access-Control-Allow-Methods": "GET, POST, OPTIONS",
-                "Access-Control-Allow-Headers": "Content-Type"
-            }
+            mimetype="application/json"
         )
     except Exception as e:
-        logging.error(f"Warmup failed: {str(e)}")
-        return func.HttpResponse(
-            json.dumps({"status": "warmup_failed", "error": str(e)}),
-            status_code=500,
-            mimetype="application/json",
-            headers={
-                "Access-Control-Allow-Origin": "*",
-                "Access-Control-Allow-Methods": "GET, POST, OPTIONS",
-                "Access-Control-Allow-Headers": "Content-Type"
-            }
-        )
+        logging.error("Warmup failed: %s", e)
+        return _error_response(_dumps({"status": "warmup_failed", "error": str(e)}))
 
 @app.route(route="ComplianceChecker", auth_level=func.AuthLevel.ANONYMOUS)
-def ComplianceChecker(req: func.HttpRequest) -> func.HttpResponse:
+async def ComplianceChecker(req: func.HttpRequest) -> func.HttpResponse:
     """Enhanced NIST compliance checker with pattern-based assessment"""
     
+    # Answer CORS preflights before any configuration, parsing or AI work
+    if req.method == "OPTIONS":
+        return func.HttpResponse(status_code=204)
+    
     # Startup logging for diagnostics
     logging.info('=== NIST Compliance Checker Starting ===')
-    logging.info(f'Function invocation ID: {req.url}')
+    logging.info('Function invocation ID: %s', req.url)
     logging.info('Checking environment variables...')
     
     endpoint = os.environ.get('AZURE_OPENAI_ENDPOINT')
@@ -404,69 +1074,129 @@ def ComplianceChecker(req: func.HttpRequest) -> func.HttpResponse:
     deployment = os.environ.get('AZURE_OPENAI_DEPLOYMENT')
     api_version = os.environ.get('AZURE_OPENAI_API_VERSION')
     
-    logging.info(f'Endpoint configured: {bool(endpoint)}')
-    logging.info(f'API key configured: {bool(api_key)}')
-    logging.info(f'Deployment configured: {bool(deployment)}')
-    logging.info(f'API version configured: {bool(api_version)}')
+    logging.info('Endpoint configured: %s', bool(endpoint))
+    logging.info('API key configured: %s', bool(api_key))
+    logging.info('Deployment configured: %s', bool(deployment))
+    logging.info('API version configured: %s', bool(api_version))
     
     if not all([endpoint, api_key, deployment]):
         logging.error('Missing required environment variables')
-        return func.HttpResponse(
-            json.dumps({"error": "Azure OpenAI configuration incomplete"}),
-            status_code=500,
-            mimetype="application/json",
-            headers={
-                "Access-Control-Allow-Origin": "*",
-                "Access-Control-Allow-Methods": "GET, POST, OPTIONS",
-                "Access-Control-Allow-Headers": "Content-Type"
-            }
-        )
+        return _error_response(b'{"error": "Azure OpenAI configuration incomplete"}')
     
     try:
         # Get uploaded file
         files = req.files
         if not files or 'document' not in files:
             return func.HttpResponse(
-                json.dumps({"error": "No PDF file uploaded. Please upload a file with name 'document'"}),
+                _dumps({"error": "No PDF file uploaded. Please upload a file with name 'document'"}),
                 status_code=400,
                 mimetype="application/json",
-                headers={
-                    "Access-Control-Allow-Origin": "*",
-                    "Access-Control-Allow-Methods": "GET, POST, OPTIONS",
-                    "Access-Control-Allow-Headers": "Content-Type"
-                }
+                headers=_ERROR_HEADERS
             )
 
         pdf_file = files['document']
-        pdf_content = pdf_file.read()
         
-        logging.info(f'Processing PDF file: {pdf_file.filename} ({len(pdf_content)} bytes)')
+        # Hash the upload in chunks straight from its stream, which the extractors then re-read
+        # after it is rewound. Hashing, extraction and tokenization are CPU-bound, so they run
+        # in the default executor and other invocations on this event loop keep making progress.
+        loop = asyncio.get_running_loop()
+        pdf_stream = pdf_file.stream
+        doc_hash, pdf_size = await loop.run_in_executor(None, _hash_stream, pdf_stream)
         
-        # Extract text from PDF
-        reader = PdfReader(io.BytesIO(pdf_content))
-        text_content = ""
+        logging.info('Processing PDF file: %s (%d bytes)', pdf_file.filename, pdf_size)
         
-        for page_num, page in enumerate(reader.pages):
-            page_text = page.extract_text()
-            text_content += f"\n--- Page {page_num + 1} ---\n{page_text}"
+        # Extract text from PDF, reusing the result for a document this worker has already seen.
+        # Caches are only touched here on the event loop; the executor gets plain values.
+        cached = _cache_get(_text_cache, doc_hash)
+        extracted, doc_slice, doc_slice_lower, doc_words = await loop.run_in_executor(None, _prepare_document, pdf_stream, cached)
+        if cached is None:
+            _cache_put(_text_cache, doc_hash, extracted, TEXT_CACHE_SIZE)
+        text_content, page_count = extracted
         
-        logging.info(f"Extracted {len(text_content)} characters from {len(reader.pages)} pages")
+        logging.info("Extracted %d characters from %d pages", len(text_content), page_count)
         
-        # Initialize Azure OpenAI client
-        logging.info('Initializing Azure OpenAI client...')
-        client = AzureOpenAI(
-            api_version=api_version,
-            azure_endpoint=endpoint,
-            api_key=api_key
-        )
-        logging.info('Azure OpenAI client initialized successfully')
+        # Reuse the worker-wide Azure OpenAI client and its connection pool
+        client = get_client()
         
-        results = []
+        # Each control is encoded as soon as it is rolled up, so only its bytes are kept
+        control_chunks = []
         current_date = datetime.now().strftime('%B %d, %Y')
         
-        # Process each NIST control
+        # Document excerpt and instructions are identical for every sub-requirement; build them once
+        document_prefix = build_document_prefix(doc_slice, current_date)
+        evidence_key = evidence_cache_key(doc_slice, current_date)
+        
+        sub_results_by_control = {control_id: [] for control_id in NIST_CONTROLS}
+        
+        # Group the sub-requirements that still need assessing by control; cached
+        # assessments of the same excerpt skip the call entirely, and sub-requirements
+        # the keyword or definition-overlap pre-filters rule out are scored locally.
+        # Every prompt in a request shares one excerpt, so sub-requirements with identical
+        # definitions are assessed once and the result is copied to the duplicates.
+        # Hits are copied out before any await: another invocation interleaving on the event
+        # loop can evict them from the shared LRU while this request's calls are in flight.
+        pending_by_control = {}
+        cached_results = {}
+        prescreened = {}
+        first_by_definition = {}
+        duplicate_of = {}
+        for control_id, control_info, sub_id, sub_info in _FLAT_SUB_REQUIREMENTS:
+            hit = _cache_get(_assessment_cache, (sub_id, evidence_key))
+            if hit is not None:
+                cached_results[sub_id] = hit
+                continue
+            if sum(keyword in doc_slice_lower for keyword in sub_info['keywords']) < KEYWORD_MIN_HITS:
+                prescreened[sub_id] = _prescreened_sub_result(sub_id, sub_info, _NO_KEYWORDS_REASONING)
+            elif len(sub_info['_definition_words'] & doc_words) < MIN_DEFINITION_OVERLAP:
+                prescreened[sub_id] = _prescreened_sub_result(sub_id, sub_info, _NO_OVERLAP_REASONING)
+            elif sub_info['definition'] in first_by_definition:
+                duplicate_of[sub_id] = first_by_definition[sub_info['definition']]
+            else:
+                first_by_definition[sub_info['definition']] = sub_id
+                pending_by_control.setdefault(control_id, []).append((sub_id, sub_info))
+        
+        pending_batches = [
+            (control_id, batch)
+            for control_id, sub_items in pending_by_control.items()
+            for batch in chunked(sub_items, MAX_BATCH_SIZE)
+        ]
+        requested = sum(map(len, pending_by_control.values()))
+        logging.info("Reusing %d cached assessments, skipping %d ruled out by pre-filters and %d duplicate definitions, requesting %d in %d batches",
+                     len(cached_results), len(prescreened), len(duplicate_of), requested, len(pending_batches))
+        
+        # Each batched call shares the document text across up to MAX_BATCH_SIZE sub-requirements
+        # of one control; batches run concurrently on the event loop, and the semaphore caps
+        # in-flight Azure OpenAI requests to stay within rate limits
+        limiter = asyncio.Semaphore(MAX_CONCURRENT_ASSESSMENTS)
+        batch_results = {}
+        for assessed in await asyncio.gather(*(
+            _assess_control(client, deployment, limiter, control_id, NIST_CONTROLS[control_id], batch, document_prefix)
+            for control_id, batch in pending_batches
+        )):
+            batch_results.update(assessed)
+        
+        # Collect in catalog order so each control's sub_requirements stay ordered
+        for control_id, _, sub_id, sub_info in _FLAT_SUB_REQUIREMENTS:
+            cache_key = (sub_id, evidence_key)
+            if sub_id in batch_results or sub_id in duplicate_of:
+                if sub_id in duplicate_of:
+                    sub_result = {**batch_results[duplicate_of[sub_id]], "sub_id": sub_id, "title": sub_info['title']}
+                else:
+                    sub_result = batch_results[sub_id]
+                if sub_result['status'] != 'Error':
+                    _cache_put(_assessment_cache, cache_key, sub_result, ASSESSMENT_CACHE_SIZE)
+            elif sub_id in prescreened:
+                sub_result = prescreened[sub_id]
+            else:
+                sub_result = cached_results[sub_id]
+            sub_results_by_control[control_id].append(sub_result)
+        
+        # The default full shape is what the bundled frontend renders; ?include=minimal is opt-in
+        minimal = req.params.get('include') == 'minimal'
+        
+        # Roll sub-requirement results up into per-control results
         for control_id, control_info in NIST_CONTROLS.items():
-            logging.info(f"=== Analyzing control {control_id}: {control_info['title']} ===")
+            sub_results = sub_results_by_control[control_id]
             
             control_result = {
                 "control_id": control_id,
@@ -478,197 +1208,48 @@ def ComplianceChecker(req: func.HttpRequest) -> func.HttpResponse:
                 "overall_evidence": "No evidence found"
             }
             
-            # Process sub-requirements
-            if control_info['sub_requirements']:
-                sub_results = []
-                
-                for sub_id, sub_info in control_info['sub_requirements'].items():
-                    logging.info(f"  → Analyzing sub-requirement {sub_id}")
-                    
-                    try:
-                        # Create pattern-based prompt
-                        prompt = create_pattern_based_prompt(sub_id, sub_info, control_info, text_content, current_date)
-                        
-                        logging.info(f"  → Calling Azure OpenAI for {sub_id}")
-                        
-                        # Call Azure OpenAI for sub-requirement
-                        ai_response = client.chat.completions.create(
-                            model=deployment,
-                            messages=[
-                                {"role": "system", "content": "You are a NIST compliance expert who applies pattern-based assessment rules consistently. Always consider control type when determining maximum possible compliance level."},
-                                {"role": "user", "content": prompt}
-                            ],
-                            max_tokens=1500,
-                            temperature=0.1
-                        )
-                        
-                        response_text = ai_response.choices[0].message.content.strip()
-                        logging.info(f"  → AI response received for {sub_id} ({len(response_text)} chars)")
-                        
-                        # Clean up response
-                        if response_text.startswith('```json'):
-                            response_text = response_text.replace('```json', '').replace('```', '').strip()
-                        
-                        try:
-                            # Additional cleanup for common JSON issues
-                            response_text = response_text.strip()
-                            if response_text.startswith('"') and response_text.endswith('"'):
-                                response_text = response_text[1:-1]  # Remove outer quotes
-                            
-                            ai_result = json.loads(response_text)
-                            
-                            # Validate required fields
-                            evidence = ai_result.get('evidence', 'No evidence found')
-                            status = ai_result.get('status', 'Does Not Meet')
-                            confidence = ai_result.get('confidence', 0.0)
-                            
-                            # Ensure confidence is a number
-                            if not isinstance(confidence, (int, float)):
-                                confidence = 0.0
-                            
-                            # Validate status values
-                            valid_statuses = ['Fully Meets', 'Partially Meets', 'Does Not Meet']
-                            if status not in valid_statuses:
-                                status = 'Does Not Meet'
-                            
-                            sub_result = {
-                                "sub_id": sub_id,
-                                "title": sub_info['title'],
-                                "definition": sub_info['definition'],
-                                "evidence": str(evidence),
-                                "status": status,
-                                "confidence": float(confidence),
-                                "assessment_reasoning": ai_result.get('assessment_reasoning', 'No reasoning provided'),
-                                "evidence_type_analysis": ai_result.get('evidence_type_analysis', 'No analysis provided')
-                            }
-                            
-                            sub_results.append(sub_result)
-                            logging.info(f"  → {sub_id} assessed as: {status} (confidence: {confidence})")
-                            
-                        except json.JSONDecodeError as json_err:
-                            logging.error(f"  → JSON parse error for {sub_id}: {str(json_err)}")
-                            logging.error(f"  → Raw response: {response_text[:200]}...")
-                            
-                            # Create a safe fallback result
-                            sub_result = {
-                                "sub_id": sub_id,
-                                "title": sub_info['title'],
-                                "definition": sub_info['definition'],
-                                "evidence": f"AI response parsing error: {str(json_err)[:100]}",
-                                "status": "Error",
-                                "confidence": 0.0,
-                                "assessment_reasoning": "JSON parsing failed",
-                                "evidence_type_analysis": "Error in processing"
-                            }
-                            sub_results.append(sub_result)
-                        except Exception as parse_err:
-                            logging.error(f"  → Unexpected parsing error for {sub_id}: {str(parse_err)}")
-                            sub_result = {
-                                "sub_id": sub_id,
-                                "title": sub_info['title'],
-                                "definition": sub_info['definition'],
-                                "evidence": f"Unexpected parsing error: {str(parse_err)[:100]}",
-                                "status": "Error",
-                                "confidence": 0.0,
-                                "assessment_reasoning": "Parsing error occurred",
-                                "evidence_type_analysis": "Error in processing"
-                            }
-                            sub_results.append(sub_result)
-                        
-                    except Exception as sub_error:
-                        logging.error(f"  → Error processing sub-requirement {sub_id}: {str(sub_error)}")
-                        sub_result = {
-                            "sub_id": sub_id,
-                            "title": sub_info['title'],
-                            "definition": sub_info['definition'],
-                            "evidence": f"Processing error: {str(sub_error)[:100]}",
-                            "status": "Error",
-                            "confidence": 0.0,
-                            "assessment_reasoning": "Processing error occurred",
-                            "evidence_type_analysis": "Error in processing"
-                        }
-                        sub_results.append(sub_result)
-                
+            if sub_results:
                 # Calculate overall control status
-                control_result["overall_status"] = calculate_overall_control_status(sub_results)
-                control_result["overall_confidence"] = calculate_overall_confidence(sub_results)
+                control_result["overall_status"], control_result["overall_confidence"] = calculate_overall_control_result(sub_results)
                 
                 # Combine evidence from successful sub-requirements
-                evidence_pieces = []
-                for r in sub_results:
-                    if r['evidence'] != 'No evidence found' and r['status'] != 'Error':
-                        # Ensure evidence is a string
-                        evidence = str(r['evidence']) if r['evidence'] else 'No evidence found'
-                        evidence_pieces.append(evidence)
+                evidence_pieces = [r['evidence'] for r in sub_results if r['evidence'] != 'No evidence found' and r['status'] != 'Error']
                 
                 if evidence_pieces:
-                    control_result["overall_evidence"] = " | ".join(evidence_pieces[:2])  # Top 2 pieces
+                    control_result["overall_evidence"] = " | ".join(deduplicate_evidence(evidence_pieces))  # Top 2 distinct pieces
                 
-                control_result["sub_requirements"] = sub_results
+                # Cached sub_results are shared, so the minimal shape is built from copies
+                control_result["sub_requirements"] = [without_catalog_fields(r) for r in sub_results] if minimal else sub_results
                 
-                logging.info(f"=== Control {control_id} overall status: {control_result['overall_status']} ===")
+                logging.info("=== Control %s overall status: %s ===", control_id, control_result['overall_status'])
             
-            results.append(control_result)
+            control_chunks.append(_dumps(without_catalog_fields(control_result) if minimal else control_result))
+        
+        logging.info('=== Assessment complete - processed %d controls ===', len(control_chunks))
+        
+        # Same bytes _dumps({"results": [...]}) would produce, assembled from the per-control chunks
+        body = b''.join((b'{"results":[', b','.join(control_chunks), b']}'))
         
-        logging.info(f'=== Assessment complete - processed {len(results)} controls ===')
+        # Output is compact by default; ?pretty=1 re-indents it for reading in a browser or curl
+        if req.params.get('pretty') == '1':
+            body = msgspec.json.format(body, indent=2)
+        
+        body, headers = _compress_body(body, req.headers.get('accept-encoding', ''))
         
         return func.HttpResponse(
-            json.dumps({"results": results}, indent=2, ensure_ascii=False),
+            body,
             status_code=200,
             mimetype="application/json",
-            headers={
-                "Access-Control-Allow-Origin": "*",
-                "Access-Control-Allow-Methods": "GET, POST, OPTIONS",
-                "Access-Control-Allow-Headers": "Content-Type"
-            }
+            headers=headers
         )
         
-    except json.JSONEncoder as json_error:
-        logging.error(f"JSON encoding error: {str(json_error)}")
-        return func.HttpResponse(
-            json.dumps({
-                "error": "JSON encoding error in response",
-                "error_type": "JSONError",
-                "details": str(json_error)[:200]
-            }),
-            status_code=500,
-            mimetype="application/json",
-            headers={
-                "Access-Control-Allow-Origin": "*",
-                "Access-Control-Allow-Methods": "GET, POST, OPTIONS", 
-                "Access-Control-Allow-Headers": "Content-Type"
-            }
-        )
     except Exception as e:
-        logging.error(f"Compliance check failed: {str(e)}")
-        logging.error(f"Error type: {type(e).__name__}")
+        # One lazily formatted record keeps the failure path CPU-only and quick to return
+        logging.error("Compliance check failed (%s): %s", type(e).__name__, e)
         
         # Ensure we return valid JSON even on error
         try:
-            error_response = {
-                "error": f"Error processing document: {str(e)}",
-                "error_type": type(e).__name__,
-                "timestamp": datetime.now(timezone.utc).isoformat()
-            }
-            return func.HttpResponse(
-                json.dumps(error_response),
-                status_code=500,
-                mimetype="application/json",
-                headers={
-                    "Access-Control-Allow-Origin": "*",
-                    "Access-Control-Allow-Methods": "GET, POST, OPTIONS",
-                    "Access-Control-Allow-Headers": "Content-Type"
-                }
-            )
-        except:
-            # Last resort - return plain text error
-            return func.HttpResponse(
-                '{"error": "Critical error - unable to process request"}',
-                status_code=500,
-                mimetype="application/json",
-                headers={
-                    "Access-Control-Allow-Origin": "*",
-                    "Access-Control-Allow-Methods": "GET, POST, OPTIONS",
-                    "Access-Control-Allow-Headers": "Content-Type"
-                }
-            )
\ No newline at end of file
+            return _build_error_response(e)
+        except Exception:
+            # Last resort - return fixed error body
+            return _error_response(_CRITICAL_ERROR_BODY)
\ No newline at end of file
@@ -0,0 +1,21 @@
+from function_app import normalize_document_text
+
+
+def test_crlf_text_from_pdfium_is_normalized():
+    # PDFium's get_text_range() separates lines with \r\n
+    text = "policy   \r\n\r\n\r\n\r\n\r\nreviewed"
+    assert normalize_document_text(text) == "policy\n\nreviewed"
+
+
+def test_line_edge_spaces_are_stripped_with_crlf():
+    text = "Access control  \r\n   policy\r\nreviewed annually"
+    assert normalize_document_text(text) == "Access control\npolicy\nreviewed annually"
+
+
+def test_lone_carriage_returns_become_newlines():
+    assert normalize_document_text("a\rb\r\r\r\rc") == "a\nb\n\nc"
+
+
+def test_page_markers_are_preserved():
+    text = "\n--- Page 1 ---\nA   b\t\tc  \n\n\n\n  d\xa0\xa0e\n--- Page 2 ---\n"
+    assert normalize_document_text(text) == "\n--- Page 1 ---\nA b c\n\nd e\n--- Page 2 ---\n"